@@ -4,7 +4,14 @@ import usb.util
 import sys
 import argparse
 import os
-import datetime
+from time import strftime, localtime
+import errno
+import array
+import mmap
+import queue
+import selectors
+import threading
+import logging
 
 # --- Конфигурация принтера ---
 # Жестко заданные Vendor ID и Product ID принтера.
@@ -17,18 +24,104 @@ PRINTER_PRODUCT_ID = 0x4117
 JOBS_FOLDER = "jobs"
 # --- Конец конфигурации ---
 
-def print_raw_to_usb(data: bytes) -> bool:
+log = logging.getLogger(__name__)
+
+# Принятые фрагменты задания копятся в памяти и сбрасываются на диск одним
+# системным вызовом writev, когда их объем достигает WRITE_BATCH_SIZE
+# или их число достигает WRITE_BATCH_PIECES.
+WRITE_BATCH_SIZE = 1 << 20
+WRITE_BATCH_PIECES = 16
+
+# Место под файл задания резервируется заранее (posix_fallocate) с удвоением
+# размера, чтобы файловая система выделяла крупные непрерывные экстенты.
+# Для небольших заданий резервирование не выполняется.
+PREALLOCATE_MIN_SIZE = 64 * 1024
+
+# Заранее подготовленные части имени файла задания
+JOB_FILE_PREFIX = os.path.join(JOBS_FOLDER, "job_")
+IP_DOTS_TO_DASHES = str.maketrans(".", "-")
+
+RECV_BUFFER_SIZE = 65536 # Размер буфера для приема данных за один раз
+
+# Пул буферов приема: буфер берется потоком приема и возвращается в пул
+# потоком записи на диск после того, как его содержимое записано в файл.
+recv_buffers = queue.LifoQueue()
+
+# Открытый USB-принтер и его конечная точка вывода используются повторно
+# для всех заданий. Запись на принтер выполняется только одним потоком за раз.
+usb_state = {"dev": None, "ep": None, "lock": threading.Lock()}
+USB_RELEASE_TIMEOUT = 2 # Сколько секунд при остановке ждать окончания записи на принтер
+
+# Очереди конвейера обработки заданий: потоки приема -> поток записи на диск
+# -> поток печати. Ограниченный размер очереди записи задерживает прием данных,
+# если диск не успевает, и не дает заданиям копиться в памяти. Очередь печати
+# не ограничена, чтобы медленный принтер не останавливал сохранение заданий:
+# сохраненные задания лежат в ней только в виде имен файлов. Задания, которые
+# не удалось сохранить, попадают в нее целиком в памяти, поэтому их число
+# ограничено MAX_MEMORY_JOBS: поток записи ждет, пока принтер их не напечатает.
+disk_queue = queue.Queue(maxsize=8) # Пачки данных (до WRITE_BATCH_SIZE байт) для записи на диск
+usb_queue = queue.Queue() # Имена файлов заданий или данные несохраненных заданий для печати
+MAX_MEMORY_JOBS = 2
+memory_jobs = threading.BoundedSemaphore(MAX_MEMORY_JOBS)
+
+# Устанавливается при остановке сервера: новые задания больше не печатаются.
+shutting_down = threading.Event()
+
+# Цикл приема не ждет освобождения очереди записи: пачки задания откладываются,
+# прием с его соединения приостанавливается, а передача повторяется
+# с этим интервалом (в секундах).
+DISK_QUEUE_RETRY_INTERVAL = 0.01
+
+# Задание передается на принтер частями по USB_CHUNK_SIZE байт (с округлением
+# до размера пакета конечной точки); таймаут каждой передачи в миллисекундах.
+USB_CHUNK_SIZE = 64 * 1024
+USB_WRITE_TIMEOUT = max(2000, USB_CHUNK_SIZE // 50)
+
+def preallocate(fd: int, allocated: int, needed: int) -> int:
     """
-    Отправляет RAW-данные напрямую на USB-принтер с жестко заданными VID/PID.
+    Резервирует место под файл так, чтобы в него поместилось needed байт.
+    Возвращает новый зарезервированный размер (или прежний, если резервирование
+    не требуется или не поддерживается).
+    """
+    if needed <= allocated or needed < PREALLOCATE_MIN_SIZE or not hasattr(os, "posix_fallocate"):
+        return allocated
+    size = max(needed, allocated * 2)
+    try:
+        os.posix_fallocate(fd, allocated, size - allocated)
+    except OSError:
+        return allocated
+    return size
+
+def write_pieces(fd: int, pieces: list) -> None:
+    """
+    Записывает в файловый дескриптор все накопленные фрагменты (memoryview)
+    и очищает список. Частичные записи дописываются повторными вызовами.
+    """
+    while pieces:
+        if hasattr(os, "writev"):
+            written = os.writev(fd, pieces)
+        else:
+            written = os.write(fd, pieces[0])
+        # Убираем полностью записанные фрагменты, остаток первого оставляем
+        while pieces and written >= len(pieces[0]):
+            written -= len(pieces.pop(0))
+        if written:
+            pieces[0] = pieces[0][written:]
+
+
+def open_usb_printer() -> bool:
+    """
+    Находит USB-принтер с жестко заданными VID/PID, захватывает его и сохраняет
+    устройство и конечную точку вывода в usb_state для повторного использования.
     Возвращает True в случае успеха, False при ошибке.
     """
     # Находим USB-устройство по Vendor ID и Product ID
     dev = usb.core.find(idVendor=PRINTER_VENDOR_ID, idProduct=PRINTER_PRODUCT_ID)
 
     if dev is None:
-        print(f"  Ошибка: Принтер с Vendor ID {hex(PRINTER_VENDOR_ID)} и Product ID {hex(PRINTER_PRODUCT_ID)} не найден.")
-        print("  Подсказка: Убедитесь, что принтер подключен, включен и его VID/PID совпадают с указанными в коде.")
-        print("  Также проверьте права доступа: возможно, потребуется запустить скрипт с 'sudo' или настроить правила 'udev'.")
+        log.error(f"Ошибка: Принтер с Vendor ID {hex(PRINTER_VENDOR_ID)} и Product ID {hex(PRINTER_PRODUCT_ID)} не найден.\n"
+                  "  Подсказка: Убедитесь, что принтер подключен, включен и его VID/PID совпадают с указанными в коде.\n"
+                  "  Также проверьте права доступа: возможно, потребуется запустить скрипт с 'sudo' или настроить правила 'udev'.")
         return False
 
     # Отсоединяем драйвер ядра от устройства, если он активен.
@@ -36,26 +129,29 @@ def print_raw_to_usb(data: bytes) -> bool:
     if sys.platform != "win32" and dev.is_kernel_driver_active(0):
         try:
             dev.detach_kernel_driver(0)
-            print("  Драйвер ядра отсоединен для прямого доступа.")
+            log.info("Драйвер ядра отсоединен для прямого доступа.")
         except usb.core.USBError as e:
-            print(f"  Не удалось отсоединить драйвер ядра: {e}")
-            print("  Подсказка: Возможно, другое приложение или драйвер удерживает контроль над принтером.")
+            log.error(f"Не удалось отсоединить драйвер ядра: {e}\n"
+                      "  Подсказка: Возможно, другое приложение или драйвер удерживает контроль над принтером.")
             usb.util.dispose_resources(dev)
             return False
 
-    # Устанавливаем активную конфигурацию и сбрасываем устройство.
-    # Сброс часто помогает принтеру выйти из некорректного состояния.
+    # Устанавливаем конфигурацию, только если у устройства нет активной:
+    # повторная установка заставляет принтер заново инициализироваться.
+    # Сброс устройства (dev.reset()) не выполняем по той же причине.
     try:
-        dev.set_configuration()
-        dev.reset()
-    except usb.core.USBError as e:
-        print(f"  Ошибка установки конфигурации/сброса USB-устройства: {e}")
-        usb.util.dispose_resources(dev)
-        return False
+        cfg = dev.get_active_configuration()
+    except usb.core.USBError:
+        try:
+            dev.set_configuration()
+            cfg = dev.get_active_configuration()
+        except usb.core.USBError as e:
+            log.error(f"Ошибка установки конфигурации USB-устройства: {e}")
+            usb.util.dispose_resources(dev)
+            return False
 
     # Находим конечную точку для вывода (OUT endpoint).
     # Это канал, через который данные будут отправляться на принтер.
-    cfg = dev.get_active_configuration()
     intf = cfg[(0,0)] # Обычно это первый интерфейс (индекс 0, альтернативная настройка 0)
     ep = usb.util.find_descriptor(
         intf,
@@ -65,123 +161,527 @@ def print_raw_to_usb(data: bytes) -> bool:
             usb.util.ENDPOINT_OUT)
 
     if ep is None:
-        print("  Ошибка: Не найдена конечная точка для вывода (OUT endpoint) на принтере.")
-        print("  Подсказка: Убедитесь, что это принтер, поддерживающий RAW-печать через USB.")
+        log.error("Ошибка: Не найдена конечная точка для вывода (OUT endpoint) на принтере.\n"
+                  "  Подсказка: Убедитесь, что это принтер, поддерживающий RAW-печать через USB.")
         usb.util.dispose_resources(dev)
         return False
 
-    print(f"  Отправка {len(data)} байт данных на принтер...")
+    usb_state["dev"] = dev
+    usb_state["ep"] = ep
+    return True
+
+
+def release_usb_printer():
+    """
+    Освобождает захваченный USB-принтер, чтобы другие приложения
+    или драйвер ядра могли снова получить доступ к устройству.
+    """
+    dev = usb_state["dev"]
+    usb_state["dev"] = None
+    usb_state["ep"] = None
+    if dev is None:
+        return
+
+    usb.util.dispose_resources(dev)
+    # Попытка присоединить драйвер ядра обратно, если он был отсоединен
     try:
-        # Отправляем данные на принтер с таймаутом в 1 секунду.
-        ep.write(data, 1000)
-        print("  Данные успешно отправлены.")
-        return True
-    except usb.core.USBError as e:
-        print(f"  Ошибка при записи данных на принтер: {e}")
-        print("  Подсказка: Принтер не отвечает, таймаут или проблемы с USB-соединением.")
-        return False
-    finally:
-        # Важно освободить ресурсы USB после использования, чтобы другие приложения
-        # или драйвер ядра могли снова получить доступ к устройству.
-        usb.util.dispose_resources(dev)
-        # Попытка присоединить драйвер ядра обратно, если он был отсоединен
         if sys.platform != "win32" and not dev.is_kernel_driver_active(0):
+            dev.attach_kernel_driver(0)
+            log.info("Драйвер ядра присоединен обратно.")
+    except usb.core.USBError as e:
+        log.error(f"Не удалось присоединить драйвер ядра обратно: {e}")
+
+
+def print_raw_to_usb(data: bytes) -> bool:
+    """
+    Отправляет RAW-данные напрямую на USB-принтер с жестко заданными VID/PID.
+    Устройство захватывается при первом задании и остается открытым для следующих;
+    если оно было отключено или зависло, оно открывается заново.
+    Возвращает True в случае успеха, False при ошибке.
+    """
+    with usb_state["lock"]:
+        log.info(f"Отправка {len(data)} байт данных на принтер...")
+        data = memoryview(data)
+        for attempt in range(2):
+            if usb_state["ep"] is None and not open_usb_printer():
+                return False
+            ep = usb_state["ep"]
+            # Отправляем данные частями, кратными максимальному размеру пакета
+            # конечной точки, чтобы каждая передача занимала канал целиком.
+            chunk = max(1, USB_CHUNK_SIZE // ep.wMaxPacketSize) * ep.wMaxPacketSize
+            offset = 0
             try:
-                dev.attach_kernel_driver(0)
-                print("  Драйвер ядра присоединен обратно.")
+                while offset < len(data):
+                    # pyusb передает array.array в libusb без преобразования, а из
+                    # memoryview собирает массив поэлементно; frombytes копирует
+                    # часть задания одним memcpy.
+                    buf = array.array('B')
+                    buf.frombytes(data[offset:offset + chunk])
+                    offset += ep.write(buf, USB_WRITE_TIMEOUT)
+                log.info("Данные успешно отправлены.")
+                return True
             except usb.core.USBError as e:
-                print(f"  Не удалось присоединить драйвер ядра обратно: {e}")
+                if e.errno in (errno.ENODEV, errno.EPIPE) and offset == 0 and attempt == 0:
+                    # Устройство переподключено или конечная точка остановлена еще до
+                    # начала передачи: открываем принтер заново и повторяем отправку.
+                    log.warning(f"Связь с принтером потеряна ({e}), повторное подключение...")
+                    release_usb_printer()
+                    continue
+                log.error(f"Ошибка при записи данных на принтер: {e}\n"
+                          "  Подсказка: Принтер не отвечает, таймаут или проблемы с USB-соединением.")
+                return False
+
+
+def get_recv_buffer() -> bytearray:
+    """
+    Возвращает свободный буфер приема из пула или создает новый.
+    """
+    try:
+        return recv_buffers.get_nowait()
+    except queue.Empty:
+        return bytearray(RECV_BUFFER_SIZE)
+
+
+def spool_to_memory(job: dict, error: OSError):
+    """
+    Переводит задание на накопление в памяти, если сохранить его в файл
+    не удалось: уже записанная часть читается обратно, файл удаляется,
+    а задание все равно будет отправлено на принтер.
+    """
+    fd, filename = job["fd"], job["filename"]
+    log.error(f"Ошибка при сохранении задания в файл '{filename}': {error}\n"
+              "  Задание будет отправлено на принтер без сохранения.")
+    data = job["data"] = bytearray()
+    # os.pread есть только в Unix; в Windows читаем с начала файла через lseek/read
+    use_pread = hasattr(os, "pread")
+    try:
+        if not use_pread:
+            os.lseek(fd, 0, os.SEEK_SET)
+        while len(data) < job["written"]:
+            size = job["written"] - len(data)
+            chunk = os.pread(fd, size, len(data)) if use_pread else os.read(fd, size)
+            if not chunk:
+                break
+            data += chunk
+    except OSError as e:
+        log.error(f"Ошибка при чтении задания из файла '{filename}': {e}\n"
+                  "  Задание не будет отправлено на принтер.")
+        job["discard"] = True
+    finally:
+        # Дескриптор закрыт: его номер может быть сразу выдан другому файлу
+        job["fd"] = None
+        os.close(fd)
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+
+def write_job_batch(job: dict, pieces: list):
+    """
+    Записывает очередную пачку фрагментов задания в его файл,
+    заранее резервируя под нее место. Если файл недоступен,
+    пачка добавляется к заданию в памяти.
+    """
+    if job["fd"] is not None:
+        batch = list(pieces) # write_pieces очищает список
+        size = sum(len(piece) for piece in batch)
+        try:
+            job["allocated"] = preallocate(job["fd"], job["allocated"], job["written"] + size)
+            write_pieces(job["fd"], pieces)
+            job["written"] += size
+            return
+        except OSError as e:
+            spool_to_memory(job, e)
+            pieces = batch
+    for piece in pieces:
+        job["data"] += piece
+
+
+def finish_job(job: dict):
+    """
+    Закрывает файл задания. Полностью принятое непустое задание передается
+    в очередь печати, недополученное или пустое удаляется.
+    """
+    fd, filename = job["fd"], job["filename"]
+    if fd is not None:
+        try:
+            # posix_fallocate увеличивает размер файла: обрезаем лишнее
+            if not job["discard"] and job["allocated"] > job["written"]:
+                os.ftruncate(fd, job["written"])
+        except OSError as e:
+            spool_to_memory(job, e)
+        else:
+            os.close(fd)
+
+    if job["data"] is not None:
+        # Задание не удалось сохранить: печатаем его из памяти
+        if not job["discard"] and job["data"]:
+            # Ждем, если в памяти уже много ненапечатанных заданий
+            while not memory_jobs.acquire(timeout=0.1):
+                if shutting_down.is_set():
+                    log.warning(f"Несохраненное задание ({len(job['data'])} байт) не напечатано из-за остановки сервера и потеряно.")
+                    return
+            usb_queue.put(job["data"])
+        return
+
+    if job["discard"] or not job["written"]:
+        os.unlink(filename)
+        return
+
+    log.info(f"Задание успешно сохранено в файл: '{filename}'")
+    usb_queue.put(filename)
+
+
+def disk_writer():
+    """
+    Поток записи на диск: сохраняет пачки данных, поступающие от потоков
+    приема, и по окончании задания передает его в очередь печати.
+    Ошибки записи не останавливают печать (см. spool_to_memory).
+    Завершается, получив из очереди (None, None).
+    """
+    while True:
+        job, pieces = disk_queue.get()
+        if job is None:
+            return
+        # Буферы, на которые ссылаются фрагменты, вернем в пул после записи
+        buffers = [piece.obj for piece in pieces] if pieces else []
+        try:
+            if pieces is None:
+                finish_job(job)
+            elif not job["discard"]:
+                write_job_batch(job, pieces)
+        except Exception as e:
+            job["discard"] = True
+            log.error(f"Произошла непредвиденная ошибка при сохранении задания: {e}")
+        finally:
+            for buf in buffers:
+                recv_buffers.put(buf)
+
+
+def report_unprinted(job):
+    """
+    Сообщает о задании из очереди печати, которое не будет напечатано
+    из-за остановки сервера.
+    """
+    if isinstance(job, str):
+        log.warning(f"Задание не напечатано из-за остановки сервера, оно сохранено в файле: '{job}'")
+    else:
+        memory_jobs.release()
+        log.warning(f"Несохраненное задание ({len(job)} байт) не напечатано из-за остановки сервера и потеряно.")
+
+
+def usb_writer():
+    """
+    Поток печати: отправляет задания на USB-принтер по очереди. В очереди
+    лежат имена сохраненных файлов или, если сохранить задание не удалось,
+    сами данные задания. Завершается, получив из очереди None.
+    """
+    while True:
+        job = usb_queue.get()
+        if job is None:
+            return
+        if shutting_down.is_set():
+            report_unprinted(job)
+            continue
+        try:
+            if isinstance(job, str):
+                # Отправляем задание на принтер прямо из файла, отображенного в память
+                with open(job, "rb") as f, \
+                     mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                     memoryview(mm) as data:
+                    print_raw_to_usb(data)
+            else:
+                try:
+                    print_raw_to_usb(job)
+                finally:
+                    memory_jobs.release()
+        except Exception as e:
+            log.error(f"Произошла непредвиденная ошибка при отправке задания на принтер: {e}")
+
+
+def accept_job(sel: selectors.BaseSelector, conn: socket.socket, addr, job_number: int):
+    """
+    Настраивает принятое соединение, создает файл для его задания и регистрирует
+    соединение в селекторе. Состояние приема хранится в словаре задания.
+    """
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.setblocking(False)
+    log.info(f"--- Получено новое задание ({job_number}) ---\n"
+             f"  Источник: {addr[0]}:{addr[1]}")
+
+    # Имя файла вычисляем сразу: данные пишутся на диск по мере приема.
+    # Имя файла включает IP-адрес клиента и порядковый номер задания для уникальности
+    filename = (JOB_FILE_PREFIX + strftime("%Y%m%d_%H%M%S_", localtime())
+                + addr[0].translate(IP_DOTS_TO_DASHES) + f"_{job_number}.prn")
+
+    # Если файл создать не удалось, задание накапливается в памяти (data)
+    # и все равно отправляется на принтер, как и без сохранения.
+    data = None
+    try:
+        # O_BINARY (есть только в Windows) отключает преобразование LF в CRLF.
+        # Чтение нужно для spool_to_memory.
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    except OSError as e:
+        log.error(f"Ошибка при создании файла задания '{filename}': {e}\n"
+                  "  Задание будет отправлено на принтер без сохранения.")
+        fd = None
+        data = bytearray()
+
+    job = {
+        # Используются потоком записи на диск
+        "filename": filename, "fd": fd, "written": 0, "allocated": 0, "discard": False, "data": data,
+        # Используются циклом приема
+        "conn": conn, "addr": addr, "mv": memoryview(get_recv_buffer()), "filled": 0,
+        "pieces": [], "pending": 0, "total": 0, "backlog": [],
+    }
+    sel.register(conn, selectors.EVENT_READ, job)
+
+
+def flush_backlog(job: dict) -> bool:
+    """
+    Передает отложенные пачки задания потоку записи на диск, не блокируя цикл
+    приема. Возвращает True, если переданы все пачки.
+    """
+    backlog = job["backlog"]
+    while backlog:
+        try:
+            disk_queue.put_nowait((job, backlog[0]))
+        except queue.Full:
+            return False
+        backlog.pop(0)
+    return True
+
+
+def send_to_disk(job: dict, pieces):
+    """
+    Передает потоку записи на диск пачку фрагментов задания (None - конец
+    задания). Если очередь записи заполнена, пачка остается в job["backlog"].
+    """
+    job["backlog"].append(pieces)
+    flush_backlog(job)
+
+
+def receive_job_data(job: dict) -> bool:
+    """
+    Читает из сокета задания доступные данные и пачками передает их потоку
+    записи на диск. Возвращает False, когда клиент закрыл соединение.
+    """
+    # Каждый буфер заполняется целиком, даже если recv_into возвращает
+    # данные мелкими порциями, поэтому на диск уходят пачки по WRITE_BATCH_SIZE.
+    mv, filled = job["mv"], job["filled"]
+    n = job["conn"].recv_into(mv[filled:])
+    if not n: # Клиент закрыл соединение
+        return False
+    filled += n
+    job["total"] += n
+    if filled == len(mv):
+        job["pieces"].append(mv)
+        job["pending"] += filled
+        mv = memoryview(get_recv_buffer())
+        filled = 0
+        if job["pending"] >= WRITE_BATCH_SIZE or len(job["pieces"]) >= WRITE_BATCH_PIECES:
+            send_to_disk(job, job["pieces"])
+            job["pieces"] = []
+            job["pending"] = 0
+    job["mv"], job["filled"] = mv, filled
+    return True
+
+
+def close_job(sel: selectors.BaseSelector, job: dict, received: bool):
+    """
+    Закрывает соединение задания. Полностью принятое задание дописывается
+    потоком записи на диск, недополученное (received=False) удаляется.
+    """
+    sel.unregister(job["conn"])
+    job["conn"].close()
+
+    mv, filled = job.pop("mv"), job["filled"]
+    if received and filled:
+        job["pieces"].append(mv[:filled])
+    else:
+        recv_buffers.put(mv.obj)
+
+    if received:
+        send_to_disk(job, job["pieces"])
+    else:
+        # Недополученное задание не сохраняем
+        job["discard"] = True
+    send_to_disk(job, None)
+
+    if received:
+        lines = [f"Размер задания '{job['filename']}': {job['total']} байт."]
+        if not job["total"]:
+            lines.append("  Получены пустые данные. Ничего не отправлено на принтер и не сохранено.")
+        log.info("\n".join(lines))
 
 
-def start_print_server(port: int):
+def stop_pipeline(sel: selectors.BaseSelector, stalled: list, disk_thread: threading.Thread):
+    """
+    Останавливает конвейер при завершении сервера: недополученные задания
+    удаляются, полностью принятые (в том числе уже переданные клиентом,
+    но еще не прочитанные) дописываются на диск, поток записи
+    завершается. Задания, ожидающие печати, не печатаются, а перечисляются в журнале.
+    """
+    shutting_down.set()
+
+    # Соединения, приостановленные из-за заполненной очереди записи, тоже закрываем
+    for job in stalled:
+        if job["conn"].fileno() != -1:
+            sel.register(job["conn"], selectors.EVENT_READ, job)
+    # Данные, уже пришедшие по соединению, дочитываем: если клиент успел
+    # передать задание целиком, оно сохраняется
+    open_jobs = [key.data for key in sel.get_map().values() if key.data is not None]
+    for job in open_jobs:
+        received = False
+        try:
+            while receive_job_data(job):
+                pass
+            received = True
+        except OSError: # В том числе BlockingIOError: клиент еще не закончил передачу
+            pass
+        close_job(sel, job, received)
+
+    # Теперь цикл приема остановлен, и ждать места в очереди записи можно
+    for job in stalled + open_jobs:
+        for pieces in job["backlog"]:
+            disk_queue.put((job, pieces))
+        job["backlog"].clear()
+    disk_queue.put((None, None))
+    disk_thread.join()
+
+    while True:
+        try:
+            job = usb_queue.get_nowait()
+        except queue.Empty:
+            break
+        if job is not None:
+            report_unprinted(job)
+    usb_queue.put(None)
+
+
+def start_print_server(port: int, rcvbuf: int = 0):
     """
     Запускает сервер, который слушает указанный порт, сохраняет задания
     и отправляет их на USB-принтер. Сервер продолжает работу при ошибках соединения.
+    Все соединения обслуживаются одним потоком через селектор (epoll в Linux),
+    поэтому медленные клиенты не занимают отдельные потоки.
+    Если rcvbuf больше нуля, он задает размер приемного буфера сокета (SO_RCVBUF),
+    иначе размер подбирается ядром автоматически.
     """
     host = '0.0.0.0' # Слушаем все доступные сетевые интерфейсы
-    buffer_size = 4096 # Размер буфера для приема данных за один раз
 
     # Создаем папку для заданий, если ее нет.
-    if not os.path.exists(JOBS_FOLDER):
-        try:
-            os.makedirs(JOBS_FOLDER)
-            print(f"Создана папка для сохранения заданий: '{JOBS_FOLDER}'")
-        except OSError as e:
-            print(f"Ошибка при создании папки '{JOBS_FOLDER}': {e}")
-            print("Подсказка: Пожалуйста, создайте ее вручную или проверьте права доступа к директории, где запускается скрипт.")
-            sys.exit(1) # Выходим, если не можем создать папку
+    try:
+        os.makedirs(JOBS_FOLDER, exist_ok=True)
+    except OSError as e:
+        log.error(f"Ошибка при создании папки '{JOBS_FOLDER}': {e}\n"
+                  "Подсказка: Пожалуйста, создайте ее вручную или проверьте права доступа к директории, где запускается скрипт.")
+        sys.exit(1) # Выходим, если не можем создать папку
 
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # Позволяем немедленное повторное использование порта после закрытия.
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Размер приемного буфера нужно задать до bind/listen, чтобы он унаследовался
+    # принятыми соединениями. Явное значение отключает автонастройку ядра.
+    if rcvbuf > 0:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sel = selectors.DefaultSelector()
+    disk_thread = None
+    stalled = [] # Задания, ждущие места в очереди записи на диск
 
     try:
         s.bind((host, port))
-        s.listen(1) # Сервер будет принимать одно входящее соединение за раз
-        print(f"Сервер запущен и слушает порт {port}...")
-        print(f"Ожидание заданий на печать для принтера с Vendor ID: {hex(PRINTER_VENDOR_ID)}, Product ID: {hex(PRINTER_PRODUCT_ID)}")
-        print(f"Задания также будут сохраняться в папку '{JOBS_FOLDER}'.")
-        print("Сервер будет продолжать работу при ошибках соединения.")
+        s.listen(16) # Очередь ожидающих соединений
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+
+        disk_thread = threading.Thread(target=disk_writer, daemon=True)
+        disk_thread.start()
+        threading.Thread(target=usb_writer, daemon=True).start()
+
+        log.info(f"Сервер запущен и слушает порт {port}...\n"
+                 f"Ожидание заданий на печать для принтера с Vendor ID: {hex(PRINTER_VENDOR_ID)}, Product ID: {hex(PRINTER_PRODUCT_ID)}\n"
+                 f"Задания также будут сохраняться в папку '{JOBS_FOLDER}'.\n"
+                 "Сервер будет продолжать работу при ошибках соединения.")
 
         job_counter = 0 # Счетчик заданий для создания уникальных имен файлов
 
         while True:
-            try:
-                conn, addr = s.accept() # Принимаем входящее соединение
-                job_counter += 1
-                print(f"\n--- Получено новое задание ({job_counter}) ---")
-                print(f"  Источник: {addr[0]}:{addr[1]}") # IP-адрес и порт клиента
-
-                with conn: # Автоматическое закрытие соединения при выходе из блока
-                    full_data = b""
-                    # Читаем все данные из сокета, пока клиент не закроет соединение
-                    while True:
-                        data = conn.recv(buffer_size)
-                        if not data: # Если данных больше нет (клиент закрыл соединение)
-                            break
-                        full_data += data
-
-                    print(f"  Размер задания: {len(full_data)} байт.")
-
-                    if full_data:
-                        # Сохраняем задание в файл
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        # Имя файла включает IP-адрес клиента и порядковый номер задания для уникальности
-                        filename = os.path.join(JOBS_FOLDER, f"job_{timestamp}_{addr[0].replace('.', '-')}_{job_counter}.prn")
-                        try:
-                            with open(filename, "wb") as f:
-                                f.write(full_data)
-                            print(f"  Задание успешно сохранено в файл: '{filename}'")
-                        except IOError as e:
-                            print(f"  Ошибка при сохранении задания в файл '{filename}': {e}")
-
-                        # Отправляем задание на принтер
-                        print_raw_to_usb(full_data)
+            # Возобновляем прием у соединений, чьи отложенные пачки удалось передать
+            for job in stalled[:]:
+                if flush_backlog(job):
+                    stalled.remove(job)
+                    if job["conn"].fileno() != -1:
+                        sel.register(job["conn"], selectors.EVENT_READ, job)
+
+            for key, _ in sel.select(DISK_QUEUE_RETRY_INTERVAL if stalled else None):
+                job = key.data
+                if job is None: # Новое соединение на слушающем сокете
+                    try:
+                        conn, addr = s.accept() # Принимаем входящее соединение
+                        # Номер расходуется только на действительно принятое соединение
+                        job_counter += 1
+                        accept_job(sel, conn, addr, job_counter)
+                    except BlockingIOError:
+                        pass # Клиент отключился, не дождавшись приема соединения
+                    except OSError as e:
+                        log.error(f"Непредвиденная ошибка сокета при приеме соединения: {e}\n"
+                                  "Сервер продолжает ожидать новые задания.")
+                    continue
+
+                addr = job["addr"]
+                try:
+                    if not receive_job_data(job):
+                        close_job(sel, job, received=True)
+                except BlockingIOError:
+                    pass # Данных пока нет, ждем следующего события
+                except OSError as e:
+                    # Обработка ошибок, которые могут возникнуть при работе с сокетом
+                    close_job(sel, job, received=False)
+                    if e.errno == 104: # Connection reset by peer
+                        log.warning(f"Внимание: Соединение с клиентом {addr[0]}:{addr[1]} было разорвано (Connection reset by peer).\n"
+                                    "Подсказка: Это часто происходит, если клиент закрывает соединение некорректно (например, 'netcat' без '-q 0').\n"
+                                    "Сервер продолжает ожидать новые задания.")
                     else:
-                        print("  Получены пустые данные. Ничего не отправлено на принтер и не сохранено.")
-            except OSError as e:
-                # Обработка ошибок, которые могут возникнуть при работе с сокетом
-                if e.errno == 104: # Connection reset by peer
-                    print(f"\nВнимание: Соединение с клиентом {addr[0]}:{addr[1]} было разорвано (Connection reset by peer).")
-                    print("Подсказка: Это часто происходит, если клиент закрывает соединение некорректно (например, 'netcat' без '-q 0').")
-                else:
-                    print(f"\nНепредвиденная ошибка сокета при обработке соединения: {e}")
-                print("Сервер продолжает ожидать новые задания.")
-            except Exception as e:
-                # Обработка любых других непредвиденных ошибок при обработке задания
-                print(f"\nПроизошла непредвиденная ошибка при обработке задания: {e}")
-                print("Сервер продолжает ожидать новые задания.")
+                        log.error(f"Непредвиденная ошибка сокета при обработке соединения: {e}\n"
+                                  "Сервер продолжает ожидать новые задания.")
+                except Exception as e:
+                    # Обработка любых других непредвиденных ошибок при обработке задания
+                    if job["conn"].fileno() != -1:
+                        close_job(sel, job, received=False)
+                    log.error(f"Произошла непредвиденная ошибка при обработке задания: {e}\n"
+                              "Сервер продолжает ожидать новые задания.")
+
+                if job["backlog"]:
+                    # Очередь записи заполнена: приостанавливаем только это соединение
+                    if job["conn"].fileno() != -1:
+                        sel.unregister(job["conn"])
+                    stalled.append(job)
 
     except OSError as e:
         # Эта часть обрабатывает ошибки, которые могут возникнуть при запуске сервера (например, занятый порт)
-        print(f"Критическая ошибка при запуске сервера: {e}")
+        lines = [f"Критическая ошибка при запуске сервера: {e}"]
         if e.errno == 98: # EADDRINUSE (Address already in use)
-            print(f"Подсказка: Порт {port} уже занят другим приложением. Пожалуйста, выберите другой порт или освободите текущий.")
+            lines.append(f"Подсказка: Порт {port} уже занят другим приложением. Пожалуйста, выберите другой порт или освободите текущий.")
+        log.critical("\n".join(lines))
     except KeyboardInterrupt:
-        print("\nСервер остановлен пользователем (Ctrl+C).")
+        log.info("Сервер остановлен пользователем (Ctrl+C).")
     finally:
+        if disk_thread is not None:
+            stop_pipeline(sel, stalled, disk_thread)
+        # Не ждем окончания печати текущего задания: если принтер занят,
+        # устройство освободит операционная система при завершении процесса.
+        if usb_state["lock"].acquire(timeout=USB_RELEASE_TIMEOUT):
+            try:
+                release_usb_printer()
+            finally:
+                usb_state["lock"].release()
+        else:
+            log.warning("Принтер занят печатью задания и не освобожден: задание будет прервано.")
+        sel.close()
         s.close()
-        print("Сетевой сокет закрыт. Сервер завершил работу.")
+        log.info("Сетевой сокет закрыт. Сервер завершил работу.")
 
 if __name__ == "__main__":
     # Настройка парсера аргументов командной строки
@@ -193,9 +693,17 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--port", type=int, default=9100,
                         help="""Номер TCP-порта для прослушивания входящих заданий (по умолчанию: 9100).
 Пример: python3 your_script.py --port 9101""")
+    parser.add_argument("--rcvbuf", type=int, default=0,
+                        help="""Размер приемного буфера сокета (SO_RCVBUF) в байтах.
+По умолчанию (0) размер подбирается ядром автоматически.
+Пример: python3 your_script.py --rcvbuf 4194304""")
 
     args = parser.parse_args()
 
+    # Сообщения сервера выводятся через logging: одно сообщение на событие
+    # вместо нескольких отдельных print.
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s", stream=sys.stdout)
+
     # --- Важное предупреждение для Linux ---
     if sys.platform != "win32": # Это предупреждение актуально только для Linux/macOS
         print("\n--- ВАЖНО для Linux ---")
@@ -207,4 +715,4 @@ if __name__ == "__main__":
         print("---")
     # --- Конец предупреждения ---
 
-    start_print_server(args.port)
\ No newline at end of file
+    start_print_server(args.port, args.rcvbuf)
\ No newline at end of file